@@ -1,10 +1,14 @@
 import os
-import json
+import functools
 import sys
 import datetime as dt
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from filelock import FileLock  # For file locking to prevent race conditions
 
 # -------- LOGGING SETUP --------
@@ -27,44 +31,56 @@ PUSHOVER_USER = os.getenv("PUSHOVER_USER", "")
 # WorldTides (optional)
 WORLDTIDES_KEY = os.getenv("WORLDTIDES_KEY", "")
 
+# -------- HTTP --------
+MARINE_URL = "https://marine-api.open-meteo.com/v1/marine"
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+WORLDTIDES_URL = "https://www.worldtides.info/api"
+PUSHOVER_URL = "https://api.pushover.net/1/messages.json"
+
+# One keep-alive session so repeated calls to the same host skip the TCP/TLS handshake
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 # -------- SCORING HELPERS --------
+def bass_sst_score_vec(c):
+    return np.select([c >= 13.0, c >= 12.0], [2, 1], default=0)
+
+def cod_sst_score_vec(c):
+    return np.select([(c >= 8.0) & (c <= 10.5), (c >= 11.0) & (c <= 12.5)], [2, 1], default=0)
+
+def wind_swell_ok_vec(wind_kt, swell_m):
+    return np.select([(swell_m <= 1.6) & (wind_kt <= 18), (swell_m <= 2.2) & (wind_kt <= 24)], [2, 1], default=0)
+
 def bass_sst_score(c):
-    if c >= 13.0: return 2
-    if 12.0 <= c < 13.0: return 1
-    return 0
+    return int(bass_sst_score_vec(np.asarray(c)))
 
 def cod_sst_score(c):
-    if 8.0 <= c <= 10.5: return 2
-    if 11.0 <= c <= 12.5: return 1
-    return 0
+    return int(cod_sst_score_vec(np.asarray(c)))
 
 def wind_swell_ok(wind_kt, swell_m):
-    return 2 if (swell_m <= 1.6 and wind_kt <= 18) else (1 if (swell_m <= 2.2 and wind_kt <= 24) else 0)
+    return int(wind_swell_ok_vec(np.asarray(wind_kt), np.asarray(swell_m)))
 
 def pressure_trend_score(trend_hpa):
     return 2 if trend_hpa < -1.0 else (1 if abs(trend_hpa) <= 1.0 else 0)
 
+# Band for each score 0..12: 0-3 RED, 4-6 AMBER-, 7-9 AMBER, 10+ GREEN
+_LABELS = ("RED",) * 4 + ("AMBER-",) * 3 + ("AMBER",) * 3 + ("GREEN",) * 3
+
 def label_from_score(x):
-    if x >= 10: return "GREEN"
-    if 7 <= x <= 9: return "AMBER"
-    if 4 <= x <= 6: return "AMBER-"
-    return "RED"
+    return _LABELS[min(max(int(x), 0), 12)]
 
 # -------- DATA FETCHERS --------
-def fetch_openmeteo():
-    start = dt.datetime.utcnow().date()
-    end = (dt.datetime.utcnow() + dt.timedelta(days=2)).date()
-    url = (
-        "https://marine-api.open-meteo.com/v1/marine"
-        f"?latitude={LAT}&longitude={LON}"
-        "&hourly=sea_surface_temperature,wind_speed_10m,wind_direction_10m,wave_height,wave_period,pressure_msl"
-        f"&start_date={start}&end_date={end}&timezone=UTC"
-    )
+def fetch_openmeteo(start, end):
+    params = {
+        "latitude": LAT, "longitude": LON,
+        "hourly": "sea_surface_temperature,wind_speed_10m,wind_direction_10m,wave_height,wave_period,pressure_msl",
+        "start_date": start, "end_date": end, "timezone": "UTC",
+    }
     try:
-        r = requests.get(url, timeout=30)
+        r = SESSION.get(MARINE_URL, params=params, timeout=30)
         r.raise_for_status()
-        return r.json()
-    except requests.RequestException as e:
+        return orjson.loads(r.content)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Failed to fetch Open-Meteo data: {e}")
         return {"hourly": {}}
 
@@ -72,59 +88,86 @@ def fetch_worldtides_extremes():
     if not WORLDTIDES_KEY:
         logger.warning("WorldTides API key missing; using approximate tides.")
         return []
-    url = f"https://www.worldtides.info/api?extremes&lat={LAT}&lon={LON}&days=2&key={WORLDTIDES_KEY}"
+    params = {"extremes": "", "lat": LAT, "lon": LON, "days": 2, "key": WORLDTIDES_KEY}
     try:
-        r = requests.get(url, timeout=30)
+        r = SESSION.get(WORLDTIDES_URL, params=params, timeout=30)
         r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
         highs = []
         for ex in data.get("extremes", []):
             if ex.get("type", "").lower() == "high":
                 t = dt.datetime.fromisoformat(ex["date"]).replace(tzinfo=dt.timezone.utc)
                 highs.append(t)
         return sorted(highs)
-    except requests.RequestException as e:
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Failed to fetch WorldTides data: {e}")
         return []
 
-def civil_twilight_for_day(date_utc):
-    url = (
-        f"https://api.open-meteo.com/v1/forecast?latitude={LAT}&longitude={LON}"
-        f"&daily=sunrise,sunset&timezone=UTC&start_date={date_utc}&end_date={date_utc}"
-    )
+@functools.lru_cache(maxsize=4)
+def civil_twilight_range(start_date, end_date):
+    params = {
+        "latitude": LAT, "longitude": LON, "daily": "sunrise,sunset", "timezone": "UTC",
+        "start_date": start_date, "end_date": end_date,
+    }
     try:
-        r = requests.get(url, timeout=20)
+        r = SESSION.get(FORECAST_URL, params=params, timeout=20)
         r.raise_for_status()
-        d = r.json()["daily"]
-        sr = dt.datetime.fromisoformat(d["sunrise"][0]).replace(tzinfo=dt.timezone.utc)
-        ss = dt.datetime.fromisoformat(d["sunset"][0]).replace(tzinfo=dt.timezone.utc)
-        dawn = (sr - dt.timedelta(minutes=30), sr + dt.timedelta(minutes=30))
-        dusk = (ss - dt.timedelta(minutes=30), ss + dt.timedelta(minutes=30))
-        return dawn, dusk
-    except requests.RequestException as e:
+        d = orjson.loads(r.content)["daily"]
+        twilight = {}
+        for day, sunrise, sunset in zip(d["time"], d["sunrise"], d["sunset"]):
+            sr = dt.datetime.fromisoformat(sunrise).replace(tzinfo=dt.timezone.utc)
+            ss = dt.datetime.fromisoformat(sunset).replace(tzinfo=dt.timezone.utc)
+            dawn = (sr - dt.timedelta(minutes=30), sr + dt.timedelta(minutes=30))
+            dusk = (ss - dt.timedelta(minutes=30), ss + dt.timedelta(minutes=30))
+            twilight[dt.date.fromisoformat(day)] = (dawn, dusk)
+        return twilight
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Failed to fetch twilight data: {e}")
-        return None, None
+        return {}
 
 # -------- UTIL --------
 def overlaps(a_start, a_end, b_start, b_end):
-    return max(a_start, b_start) < min(a_end, b_end)
+    # Works elementwise (with broadcasting) on epoch-second arrays as well as on scalars
+    return np.maximum(a_start, b_start) < np.minimum(a_end, b_end)
 
 def pick_flood_windows(high_tides):
     return [(ht - dt.timedelta(hours=2), ht) for ht in high_tides]
 
+def epoch_seconds(times):
+    return np.array([t.timestamp() for t in times], dtype=np.int64)
+
+def nearest_index(sorted_ts, targets):
+    # Index of the closest entry in sorted_ts for each target; ties go to the earlier entry
+    if len(sorted_ts) == 0:
+        return np.zeros(len(targets), dtype=np.intp)
+    pos = np.searchsorted(sorted_ts, targets)
+    after = pos.clip(max=len(sorted_ts) - 1)
+    before = (pos - 1).clip(min=0)
+    closer_after = np.abs(sorted_ts[after] - targets) < np.abs(sorted_ts[before] - targets)
+    return np.where(closer_after, after, before)
+
+def gather(values, idxs, default):
+    # Pick values at idxs, falling back to default where the series is too short
+    arr = np.asarray(values, dtype=np.float64)
+    out = np.full(len(idxs), default, dtype=np.float64)
+    ok = idxs < len(arr)
+    out[ok] = arr[idxs[ok]]
+    return out
+
 # -------- PUSHOVER --------
-def send_push(rec, band):
+_CARDINALS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+              "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+
+def send_push(rec, band, now):
     if not (PUSHOVER_TOKEN and PUSHOVER_USER):
         logger.error("Pushover not configured: missing token or user key.")
         return False
-    now_str = dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+    now_str = now.strftime("%Y-%m-%d %H:%M UTC")
     tip = "Bass: lug+squid in coloured surf. Cod: lug/squid wraps."
     
     # Convert wind direction from degrees to cardinal direction
     wind_dir_deg = rec.get("wind_dir", 225)  # Default to SW (225°) if missing
-    cardinal_dirs = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", 
-                     "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-    wind_dir = cardinal_dirs[int((wind_dir_deg % 360) / 22.5 + 0.5) % 16]
+    wind_dir = _CARDINALS[int((wind_dir_deg * 16 + 180) // 360) & 15]
     
     body = (
         f"Date/Time: {now_str}\n"
@@ -137,8 +180,8 @@ def send_push(rec, band):
         f"Tip: {tip}"
     )
     try:
-        response = requests.post(
-            "https://api.pushover.net/1/messages.json",
+        response = SESSION.post(
+            PUSHOVER_URL,
             data={
                 "token": PUSHOVER_TOKEN,
                 "user": PUSHOVER_USER,
@@ -155,26 +198,44 @@ def send_push(rec, band):
         return False
 
 # -------- MAIN --------
-def main():
+def write_state(state_path, state):
+    # Write to a temp file and rename over the original so a crash never leaves a truncated file
+    tmp = state_path.with_suffix(".json.tmp")
+    tmp.write_bytes(orjson.dumps(state))
+    os.replace(tmp, state_path)
+
+def run(state_path):
     # Load state
-    state_path = Path("state.json")
-    lock_path = Path("state.json.lock")
     state = {}
-    with FileLock(lock_path):
-        if state_path.exists():
-            try:
-                state = json.loads(state_path.read_text())
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse state.json: {e}")
-                state = {}
-
-    today = dt.datetime.utcnow().date().isoformat()
+    if state_path.exists():
+        try:
+            state = orjson.loads(state_path.read_bytes())
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Failed to parse state.json: {e}")
+            state = {}
+
+    # Read the clock once so every date derived below agrees
+    now = dt.datetime.now(dt.timezone.utc)
+    today = now.date().isoformat()
     sent_green_today = state.get(today, {}).get("green", False)
     sent_amber_today = state.get(today, {}).get("amber", False)
+    if sent_green_today and sent_amber_today:
+        logger.info("Both alerts already sent today.")
+        return 0
+
+    # Sorted so iteration order is deterministic (a bare set is not)
+    candidate_days = sorted({now.date(), (now + dt.timedelta(days=1)).date()})
 
-    # Fetch data
-    met = fetch_openmeteo()
-    highs = fetch_worldtides_extremes()
+    # Fetch data; the requests are independent so issue them concurrently
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        met_future = ex.submit(fetch_openmeteo, now.date(), now.date() + dt.timedelta(days=2))
+        highs_future = ex.submit(fetch_worldtides_extremes)
+        twilight_future = ex.submit(
+            civil_twilight_range, candidate_days[0].isoformat(), candidate_days[-1].isoformat()
+        )
+        met = met_future.result()
+        highs = highs_future.result()
+        twilight_by_day = twilight_future.result()
 
     # Hourly data
     tstrs = met["hourly"].get("time", [])
@@ -185,22 +246,23 @@ def main():
     wavep = met["hourly"].get("wave_period", [])
     psl = met["hourly"].get("pressure_msl", [])
 
-    hours = [dt.datetime.fromisoformat(t).replace(tzinfo=dt.timezone.utc) for t in tstrs]
-    now = dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
+    # Open-Meteo returns naive UTC ISO-8601 strings, which numpy parses directly
+    hours_np = np.array(tstrs, dtype="datetime64[s]")
 
-    # Pressure trend
-    try:
-        p_now = psl[-1]
-        p_prev = psl[len(psl) // 2]
-        p_trend = (p_now - p_prev) if (p_now and p_prev) else 0.0
-    except:
+    # Pressure trend: least-squares slope over the last 24 hourly readings, in hPa per 24 h
+    p_tail = np.asarray(psl, dtype=np.float64)[-24:]
+    p_hours = np.arange(len(p_tail))
+    p_ok = np.isfinite(p_tail)
+    if p_ok.sum() >= 2:
+        p_trend = float(np.polyfit(p_hours[p_ok], p_tail[p_ok], 1)[0]) * 24
+    else:
         p_trend = 0.0
         logger.warning("Failed to calculate pressure trend; using 0.0.")
 
     # Fallback tides if no API key
     if not highs:
         approx_hts = []
-        for d in [now.date(), (now + dt.timedelta(days=1)).date()]:
+        for d in candidate_days:
             approx_hts += [
                 dt.datetime(d.year, d.month, d.day, 6, 0, tzinfo=dt.timezone.utc),
                 dt.datetime(d.year, d.month, d.day, 18, 0, tzinfo=dt.timezone.utc)
@@ -209,54 +271,62 @@ def main():
 
     flood_windows = pick_flood_windows(highs)
 
-    # Build candidate windows
-    windows = []
-    for day in {now.date(), (now + dt.timedelta(days=1)).date()}:
-        dawn, dusk = civil_twilight_for_day(day.isoformat())
-        if dawn is None or dusk is None:
-            continue
-        for fw_start, fw_end in flood_windows:
-            if fw_start.date() != day:
-                continue
-            label = None
-            if overlaps(fw_start, fw_end, *dawn):
-                label = "dawn"
-            if overlaps(fw_start, fw_end, *dusk):
-                label = "dusk" if label is None else label
-            if not label:
-                continue
-            if fw_end < now or fw_start > now + dt.timedelta(hours=24):
-                continue
-            windows.append((fw_start, fw_end, label))
-
-    # Score
-    scored = []
-    for start, end, label in windows:
-        mid = start + (end - start) / 2
-        idx = min(range(len(hours)), key=lambda i: abs(hours[i] - mid))
-        val_sst = sst[idx] if idx < len(sst) else 12.0
-        val_wind = wind[idx] if idx < len(wind) else 6.0
-        val_wind_dir = wind_dir[idx] if idx < len(wind_dir) else 225  # Default SW
-        val_wave = waveh[idx] if idx < len(waveh) else 1.2
-        val_wavep = wavep[idx] if idx < len(wavep) else 9.0
-        wind_kt = val_wind * 1.94384
-
-        b = bass_sst_score(val_sst) + 2 + wind_swell_ok(wind_kt, val_wave) + pressure_trend_score(p_trend) + 1
-        c = cod_sst_score(val_sst)
-        c += 2 if (0.8 <= val_wave <= 1.8) else (1 if val_wave > 1.8 else 0)
-        c += 2 + pressure_trend_score(p_trend) + 1
-
-        scored.append({
-            "start": start, "end": end, "label": label,
-            "sst": val_sst, "wind_kt": wind_kt, "wind_dir": val_wind_dir,
-            "wave_m": val_wave, "wavep": val_wavep,
-            "bass": int(b), "cod": int(c)
-        })
-
-    if not scored:
+    # Build candidate windows: flood windows overlapping dawn/dusk on their own day, within the next 24 h
+    days = [day for day in candidate_days if day in twilight_by_day]
+    day_nums = np.array([(day - dt.date(1970, 1, 1)).days for day in days], dtype=np.int64)
+    dawns = [twilight_by_day[day][0] for day in days]
+    dusks = [twilight_by_day[day][1] for day in days]
+    dawn_start, dawn_end = epoch_seconds([a for a, _ in dawns]), epoch_seconds([b for _, b in dawns])
+    dusk_start, dusk_end = epoch_seconds([a for a, _ in dusks]), epoch_seconds([b for _, b in dusks])
+    fw_start = epoch_seconds([s for s, _ in flood_windows])
+    fw_end = epoch_seconds([e for _, e in flood_windows])
+    now_ts = int(now.timestamp())
+
+    # (day, tide) matrices
+    dawn_overlap = overlaps(fw_start, fw_end, dawn_start[:, None], dawn_end[:, None])
+    dusk_overlap = overlaps(fw_start, fw_end, dusk_start[:, None], dusk_end[:, None])
+    same_day = (fw_start // 86400) == day_nums[:, None]
+    upcoming = (fw_end >= now_ts) & (fw_start <= now_ts + 24 * 3600)
+    keep = same_day & (dawn_overlap | dusk_overlap) & upcoming
+    labels = np.where(dawn_overlap, "dawn", "dusk")
+
+    day_idx, tide_idx = np.nonzero(keep)
+    windows = [(*flood_windows[t], str(labels[d, t])) for d, t in zip(day_idx, tide_idx)]
+
+    if not windows:
         logger.info("No qualifying windows.")
         return 0
 
+    # Score all windows at once against the nearest hourly sample
+    hours_ts = hours_np.astype(np.int64)
+    mids_ts = (fw_start[tide_idx] + fw_end[tide_idx]) / 2
+    idxs = nearest_index(hours_ts, mids_ts)
+    sst_vals = gather(sst, idxs, 12.0)
+    wind_vals = gather(wind, idxs, 6.0)
+    wind_dir_vals = gather(wind_dir, idxs, 225)  # Default SW
+    wave_vals = gather(waveh, idxs, 1.2)
+    wavep_vals = gather(wavep, idxs, 9.0)
+    wind_kt = wind_vals * 1.94384
+    p_score = pressure_trend_score(p_trend)
+
+    bass_sst = bass_sst_score_vec(sst_vals)
+    cod_sst = cod_sst_score_vec(sst_vals)
+    conditions = wind_swell_ok_vec(wind_kt, wave_vals)
+    surf = np.select([(wave_vals >= 0.8) & (wave_vals <= 1.8), wave_vals > 1.8], [2, 1], default=0)
+
+    bass = bass_sst + 2 + conditions + p_score + 1
+    cod = cod_sst + surf + 2 + p_score + 1
+
+    scored = [
+        {
+            "start": start, "end": end, "label": label,
+            "sst": float(sst_vals[i]), "wind_kt": float(wind_kt[i]), "wind_dir": float(wind_dir_vals[i]),
+            "wave_m": float(wave_vals[i]), "wavep": float(wavep_vals[i]),
+            "bass": int(bass[i]), "cod": int(cod[i])
+        }
+        for i, (start, end, label) in enumerate(windows)
+    ]
+
     def best_score(rec): return max(rec["bass"], rec["cod"])
     greens = [r for r in scored if best_score(r) >= 10]
     ambers = [r for r in scored if 7 <= best_score(r) <= 9]
@@ -271,22 +341,21 @@ def main():
     pick_amber = pick_best(ambers)
 
     updated = False
-    with FileLock(lock_path):
-        if pick_green and not sent_green_today:
-            if send_push(pick_green, "GREEN"):
-                state.setdefault(today, {})["green"] = True
-                updated = True
-        if pick_amber and not sent_amber_today:
-            if send_push(pick_amber, "AMBER"):
-                state.setdefault(today, {})["amber"] = True
-                updated = True
-
-        if updated:
-            try:
-                state_path.write_text(json.dumps(state, indent=2))
-                logger.info("State updated and saved.")
-            except OSError as e:
-                logger.error(f"Failed to write state.json: {e}")
+    if pick_green and not sent_green_today:
+        if send_push(pick_green, "GREEN", now):
+            state.setdefault(today, {})["green"] = True
+            updated = True
+    if pick_amber and not sent_amber_today:
+        if send_push(pick_amber, "AMBER", now):
+            state.setdefault(today, {})["amber"] = True
+            updated = True
+
+    if updated:
+        try:
+            write_state(state_path, state)
+            logger.info("State updated and saved.")
+        except OSError as e:
+            logger.error(f"Failed to write state.json: {e}")
 
     if updated:
         logger.info("Alerts sent.")
@@ -295,5 +364,10 @@ def main():
 
     return 0
 
+def main():
+    # Hold the lock for the whole read-alert-write cycle so overlapping runs can't double-send
+    with FileLock(Path("state.json.lock")):
+        return run(Path("state.json"))
+
 if __name__ == "__main__":
     sys.exit(main())